@@ -26,7 +26,8 @@ import pandas as pd
 import numpy as np
 
 
-from scipy.stats import truncnorm
+from joblib import parallel_backend
+from sklearn import config_context
 from sklearn.impute import KNNImputer
 
 # TODO a) add check functions for interface
@@ -47,32 +48,101 @@ STR_MNAR = "MNAR"
 STR_MAR = "MAR"
 STR_NM = "NM"
 LIST_MV_CLASSES = [STR_MCAR, STR_MNAR, STR_MAR, STR_NM]
+# Integer codes of MV classes (position in LIST_MV_CLASSES) used internally
+INT_MCAR, INT_MNAR, INT_MAR, INT_NM = range(len(LIST_MV_CLASSES))
 STR_CS = "CS"
 STR_MV_LABELS = "labels"
+KNN_WORKING_MEMORY = 16     # Memory (MB) for chunks of pairwise distances in KNN imputation
+KNN_N_JOBS = -1             # Number of threads for pairwise distances in KNN imputation (-1 for all cores)
 
 
 # I Helper Functions
-def _compute_cs(vals=None, mv_class=None, n=None):
+def _truncnorm_rvs(size=None, loc=0, scale=1):
+    """Draw random numbers from normal distribution truncated to [loc, loc + scale]
+    (equivalent to scipy.stats.truncnorm.rvs(a=0, b=1, loc=loc, scale=scale))
+
+    Notes
+    -----
+    Samples of the standard half-normal distribution |N(0, 1)| are rejected if they exceed 1
+    (acceptance rate ~68%) and just the rejected positions are redrawn until all samples are accepted.
+    """
+    samples = np.full(size, np.inf)
+    mask_rejected = samples > 1
+    while mask_rejected.any():
+        samples[mask_rejected] = np.abs(np.random.standard_normal(mask_rejected.sum()))
+        mask_rejected = samples > 1
+    return loc + scale * samples
+
+
+def _count_mvs(X=None, up_mnar=None, mask_nan=None):
+    """Count missing values and detected values higher or lower/equal than upMNAR per protein (row)"""
+    if mask_nan is None:
+        mask_nan = np.isnan(X)
+    n_nan = mask_nan.sum(axis=1)
+    n_higher_up_mnar = (X > up_mnar).sum(axis=1)    # Comparisons with NaN are False
+    n_lower_or_equal_up_mnar = X.shape[1] - n_nan - n_higher_up_mnar
+    return n_nan, n_higher_up_mnar, n_lower_or_equal_up_mnar
+
+
+def _classify_of_mvs(n_nan=None, n_higher_up_mnar=None, n_lower_or_equal_up_mnar=None):
+    """Classify missing values of proteins based on counts from _count_mvs"""
+    n = n_nan + n_higher_up_mnar + n_lower_or_equal_up_mnar
+    conditions = [n_lower_or_equal_up_mnar + n_nan == n,    # MNAR (Missing Not At Random)
+                  n_higher_up_mnar + n_nan == n,            # MCAR (Missing Completely At Random)
+                  n_nan == 0]                               # NM (No Missing values)
+    # MAR (Missing At Random) for all remaining proteins
+    mv_classes = np.select(conditions, [INT_MNAR, INT_MCAR, INT_NM], default=INT_MAR).astype(np.int8)
+    return mv_classes
+
+
+def _get_mv_codes(mv_classes=None):
+    """Convert MV classes given as names (LIST_MV_CLASSES) or integer codes into array of integer codes"""
+    mv_classes = np.asarray(mv_classes)
+    if mv_classes.size == 0:
+        return mv_classes.astype(np.int8)
+    if mv_classes.dtype.kind in "UOS":
+        wrong_classes = set(mv_classes.tolist()).difference(LIST_MV_CLASSES)
+        if wrong_classes:
+            raise ValueError(f"'mv_classes' contains invalid classes {sorted(map(str, wrong_classes))}, "
+                             f"which should be in {LIST_MV_CLASSES}")
+        return np.array([LIST_MV_CLASSES.index(c) for c in mv_classes.tolist()], dtype=np.int8)
+    list_codes = list(range(len(LIST_MV_CLASSES)))
+    if mv_classes.dtype.kind not in "iu" or not np.isin(mv_classes, list_codes).all():
+        raise ValueError(f"'mv_classes' should be MV class names {LIST_MV_CLASSES} or integer codes {list_codes}")
+    return mv_classes
+
+
+def _compute_cs(mv_classes=None, n_nan=None, n=None):
     """Compute confidence score (CS) depending on missing value category and
     proportion of missing values"""
-    count_nan = lambda val: len([x for x in val if str(x) == "nan"])
-    if mv_class == STR_NM:
-        return 1
-    elif mv_class == STR_MAR:
-        return 0
-    elif mv_class == STR_MCAR:
-        return round((n - count_nan(vals)) / n, 2)
-    elif mv_class == STR_MNAR:
-        return round(count_nan(vals) / n, 2)
-
-
-def _impute_mnr(df=None, std_factor=0.5, d_min=None, up_mnar=None):
+    mv_classes = _get_mv_codes(mv_classes=mv_classes)
+    conditions = [mv_classes == INT_NM, mv_classes == INT_MAR, mv_classes == INT_MCAR, mv_classes == INT_MNAR]
+    choices = [1, 0, (n - n_nan) / n, n_nan / n]
+    cs = np.select(conditions, choices, default=np.nan)
+    # Python round (instead of np.round) for few unique ratios, since np.round differs for some ratios (e.g., 1/40)
+    cs_unique, inverse = np.unique(cs, return_inverse=True)
+    cs = np.array([round(x, 2) for x in cs_unique.tolist()])[inverse.reshape(-1)]
+    return cs
+
+
+def _get_limits(X=None, loc_up_mnar=0.1):
+    """Get minimum (d_min) and maximum (d_max) of detected values and upper bound of MNAR MVs (up_mnar)"""
+    d_min = np.nanmin(X)    # Detection limit
+    d_max = np.nanmax(X)    # Largest detected value
+    dr = d_max - d_min      # Detection range
+    up_mnar = d_min + loc_up_mnar * dr   # Upper MNAR border
+    return d_min, up_mnar, d_max
+
+
+def _impute_mnr(X=None, mask_nan=None, std_factor=0.5, d_min=None, up_mnar=None):
     """MinProb imputation as suggested by Lazar et al., 2016
 
     Arguments
     --------
-    df: DataFrame
-        DataFrame with missing values just classified as MNAR
+    X: array
+        Array with missing values just classified as MNAR, imputed in-place
+    mask_nan: array, optional
+        Boolean mask of missing values in X (computed if not given)
     std_factor: int, default = 0.5
         Factor to control size of standard deviation of distribution relative to distance of upMNAR and Dmin.
 
@@ -85,103 +155,125 @@ def _impute_mnr(df=None, std_factor=0.5, d_min=None, up_mnar=None):
     https://www.rdocumentation.org/packages/imputeLCMD/versions/2.0/topics/impute.MinProb
     https://bioconductor.org/packages/release/bioc/vignettes/DEP/inst/doc/MissingValues.html
     """
-    df = df.copy()
-    d1, d2 = df.shape
+    if mask_nan is None:
+        mask_nan = np.isnan(X)
     std = (up_mnar - d_min) * std_factor   # Standard deviation (spread, scale, or "width")
-    # Generate random numbers using truncated (left-censored) normal distribution
-    vals = truncnorm.rvs(a=0, b=1, size=d1*d2, loc=d_min, scale=std).reshape((d1, d2))
-    mask = df.isnull()
-    df[mask] = vals
-    return df
+    # Generate random numbers using truncated (left-censored) normal distribution just for missing values
+    X[mask_nan] = _truncnorm_rvs(size=int(mask_nan.sum()), loc=d_min, scale=std)
+    return X
 
 
-def _impute_mcar(df=None, n_neighbors=6):
-    """KNN imputation via sklearn implementation
+def _impute_mcar(X=None, mask_nan=None, knn_imputer=None, n_neighbors=6):
+    """KNN imputation via sklearn implementation (in-place)
 
     Arguments
     ---------
-    df: DataFrame
-        DataFrame with missing values just classified as MNAR
+    X: array
+        Array with missing values just classified as MCAR, imputed in-place
+    mask_nan: array, optional
+        Boolean mask of missing values in X (computed if not given)
+    knn_imputer: KNNImputer, optional
+        Imputer reused across calls. If None, a new one is created using n_neighbors
     n neighbors: int, default=6 (Liu and Dongre, 2020)
         Number of neighboring samples to use for imputation
-    """
-    imputer = KNNImputer(n_neighbors=n_neighbors)
-    X = np.array(df)
-    index, cols = df.index, df.columns
-    X = imputer.fit_transform(X)
-    df = pd.DataFrame(X, columns=cols, index=index)
-    return df
-
 
-def _impute(df=None, mv_class=None, d_min=None, up_mnar=None, std_factor=0.5, n_neighbors=6):
+    Notes
+    -----
+    KNN imputation is applied per experimental group on purpose: neighbors must be selected from proteins
+    passing the CS threshold in the same group, using only distances between samples of this group.
+    Batching all groups into one KNN run would mix neighbors across groups and change the imputed values.
+    """
+    if knn_imputer is None:
+        knn_imputer = KNNImputer(n_neighbors=n_neighbors)
+    # Distances are computed in float32 (sufficient for log2 intensities) to halve memory traffic
+    # Small distance chunks computed in parallel threads (KNNImputer does not expose n_jobs itself)
+    with config_context(working_memory=KNN_WORKING_MEMORY), parallel_backend("threading", n_jobs=KNN_N_JOBS):
+        X_imputed = knn_imputer.fit_transform(X.astype(np.float32))
+    if mask_nan is None:
+        mask_nan = np.isnan(X)
+    X[mask_nan] = X_imputed[mask_nan]
+    return X
+
+
+def _impute_group(X=None, cols=slice(None), mv_classes=None, list_cs=None, min_cs=0.5, d_min=None, up_mnar=None,
+                  n_neighbors=5, std_factor=0.5, knn_imputer=None, mask_nan=None):
+    """Imputation of an experimental group given by columns (cols) of X, where imputed rows are scattered
+    back into X in-place"""
+    mv_classes = _get_mv_codes(mv_classes=mv_classes)
+    if mask_nan is None:
+        mask_nan = np.isnan(X[:, cols])
+    args = dict(n_neighbors=n_neighbors, std_factor=std_factor, d_min=d_min, up_mnar=up_mnar,
+                knn_imputer=knn_imputer)
+    mask_cs = np.asarray(list_cs) >= min_cs
+    # NM (no MVs) and MAR are not imputed
+    for mv_class in [INT_MCAR, INT_MNAR]:
+        rows = np.flatnonzero((mv_classes == mv_class) & mask_cs)
+        if len(rows) == 0:
+            continue
+        X[rows, cols] = _impute(X=X[rows, cols], mask_nan=mask_nan[rows], mv_class=mv_class, **args)
+    return X
+
+
+def _impute(X=None, mask_nan=None, mv_class=None, d_min=None, up_mnar=None, std_factor=0.5, n_neighbors=6,
+            knn_imputer=None):
     """Wrapper for imputation methods applied on an experimental group"""
-    if mv_class == STR_NM:
-        return df
-    elif mv_class == STR_MAR:
-        return df
-    elif mv_class == STR_MCAR:
-        return _impute_mcar(df=df, n_neighbors=n_neighbors)
-    elif mv_class == STR_MNAR:
-        return _impute_mnr(df=df, d_min=d_min, std_factor=std_factor, up_mnar=up_mnar)
+    if mv_class == INT_NM:
+        return X
+    elif mv_class == INT_MAR:
+        return X
+    elif mv_class == INT_MCAR:
+        return _impute_mcar(X=X, mask_nan=mask_nan, knn_imputer=knn_imputer, n_neighbors=n_neighbors)
+    elif mv_class == INT_MNAR:
+        return _impute_mnr(X=X, mask_nan=mask_nan, d_min=d_min, std_factor=std_factor, up_mnar=up_mnar)
 
 
 # II Main Functions
 def get_up_mnar(df=None, loc_up_mnar=0.1):
-    """Get upper bound for MNAR MVs for whole data set"""
-    d_min = df.min().min()  # Detection limit
-    d_max = df.max().max()  # Largest detected value
-    dr = d_max - d_min      # Detection range
-    up_mnar = d_min + loc_up_mnar * dr   # Upper MNAR border
+    """Get upper bound for MNAR MVs for whole data set (df can be given as DataFrame or array)"""
+    d_min, up_mnar, _ = _get_limits(X=np.asarray(df, dtype=np.float64), loc_up_mnar=loc_up_mnar)
     return d_min, up_mnar
 
 
 def classify_of_mvs(df_group=None, up_mnar=None):
-    """Classification of missing values for given protein intensities of an experimental group"""
-    n_groups = len(list(df_group))
-    mv_classes = []     # NaN Classes
-    for i, row in df_group.iterrows():
-        n_nan = row.isnull().sum()
-        n_higher_up_mnar = np.array((row > up_mnar)).sum()
-        n_lower_or_equal_up_mnar = np.array((row <= up_mnar)).sum()
-        # MNAR (Missing Not At Random)
-        if n_lower_or_equal_up_mnar + n_nan == n_groups:
-            mv_classes.append(STR_MNAR)
-        # MCAR (Missing Completely At Random)
-        elif n_higher_up_mnar + n_nan == n_groups:
-            mv_classes.append(STR_MCAR)
-        # NM (No Missing values)
-        elif n_higher_up_mnar + n_lower_or_equal_up_mnar == n_groups:
-            mv_classes.append(STR_NM)
-        # MAR (Missing At Random)
-        else:
-            mv_classes.append(STR_MAR)
+    """Classification of missing values for given protein intensities of an experimental group.
+    MV classes are returned as integer codes (position in LIST_MV_CLASSES)"""
+    X = np.asarray(df_group, dtype=np.float64)
+    n_nan, n_higher_up_mnar, n_lower_or_equal_up_mnar = _count_mvs(X=X, up_mnar=up_mnar)
+    mv_classes = _classify_of_mvs(n_nan=n_nan,
+                                  n_higher_up_mnar=n_higher_up_mnar,
+                                  n_lower_or_equal_up_mnar=n_lower_or_equal_up_mnar)
     return mv_classes
 
 
 def compute_cs(df_group=None, mv_classes=None):
     """Computation of confidence scores depending on missing value classification and proportion of missing values"""
-    n = len(list(df_group))
-    dict_prot_cs = {}
-    for mv_class in LIST_MV_CLASSES:
-        mask = [True if l == mv_class else False for l in mv_classes]
-        df = df_group[mask]
-        for entry, row in df.iterrows():
-            cs = _compute_cs(vals=list(row), mv_class=mv_class, n=n)
-            dict_prot_cs[entry] = cs
-    list_cs = [dict_prot_cs[entry] for entry in df_group.index]
-    return list_cs
+    X = np.asarray(df_group, dtype=np.float64)
+    n_nan = np.isnan(X).sum(axis=1)
+    cs = _compute_cs(mv_classes=mv_classes, n_nan=n_nan, n=X.shape[1])
+    return cs
+
+
+def classify_and_compute_cs(df_group=None, up_mnar=None, mask_nan=None):
+    """Classification of missing values and computation of confidence scores in one pass over
+    protein intensities of an experimental group (combination of classify_of_mvs and compute_cs)"""
+    X = np.asarray(df_group, dtype=np.float64)
+    n_nan, n_higher_up_mnar, n_lower_or_equal_up_mnar = _count_mvs(X=X, up_mnar=up_mnar, mask_nan=mask_nan)
+    mv_classes = _classify_of_mvs(n_nan=n_nan,
+                                  n_higher_up_mnar=n_higher_up_mnar,
+                                  n_lower_or_equal_up_mnar=n_lower_or_equal_up_mnar)
+    cs = _compute_cs(mv_classes=mv_classes, n_nan=n_nan, n=X.shape[1])
+    return mv_classes, cs
 
 
 def impute(df_group=None, mv_classes=None, list_cs=None, min_cs=0.5, d_min=None, up_mnar=None,
-           n_neighbors=5, std_factor=0.5):
-    """Group-wise imputation over whole data set"""
-    df_group = df_group.copy()
-    args = dict(n_neighbors=n_neighbors, std_factor=std_factor, d_min=d_min, up_mnar=up_mnar)
-    for mv_class in LIST_MV_CLASSES:
-        mask = np.array([True if (l == mv_class and cs >= min_cs) else False
-                         for l, cs in zip(mv_classes, list_cs)])
-        df_group[mask] = _impute(df=df_group[mask], mv_class=mv_class, **args)
-    return df_group
+           n_neighbors=5, std_factor=0.5, knn_imputer=None, mask_nan=None):
+    """Group-wise imputation over whole data set (df_group can be given as DataFrame or array)"""
+    X = np.array(df_group, dtype=np.float64)
+    _impute_group(X=X, mv_classes=mv_classes, list_cs=list_cs, min_cs=min_cs, d_min=d_min, up_mnar=up_mnar,
+                  n_neighbors=n_neighbors, std_factor=std_factor, knn_imputer=knn_imputer, mask_nan=mask_nan)
+    if isinstance(df_group, pd.DataFrame):
+        return pd.DataFrame(X, index=df_group.index, columns=df_group.columns)
+    return X
 
 
 # Wrapper
@@ -200,6 +292,13 @@ class cImpute:
         self.list_mv_classes = LIST_MV_CLASSES
         self.str_id = str_id
         self.str_lfq = str_lfq
+        self._knn_imputer = None
+
+    def _get_knn_imputer(self, n_neighbors=6):
+        """Get KNNImputer, which is only (re-)created if not existing or if n_neighbors changed"""
+        if self._knn_imputer is None or self._knn_imputer.n_neighbors != n_neighbors:
+            self._knn_imputer = KNNImputer(n_neighbors=n_neighbors)
+        return self._knn_imputer
 
     def get_dict_groups(self, df=None, groups=None, group_to_col=True):
         """Get dictionary with groups from df based on lfq_str and given groups
@@ -221,14 +320,16 @@ class cImpute:
             Dictionary assigning groups (keys) to list of column names (values) if group_to_col=True
         """
         dict_col_group = {}
+        dict_group_cols = {g: [] for g in groups}
         for col in list(df):
             if self.str_lfq in col:
                 col_wo_lfq_str = col.replace(self.str_lfq, "")
-                for group in groups:
-                    if group in col_wo_lfq_str:
-                        dict_col_group[col] = group
+                # Last matching group is assigned if group name is contained in multiple groups
+                group = next((g for g in reversed(groups) if g in col_wo_lfq_str), None)
+                if group is not None:
+                    dict_col_group[col] = group
+                    dict_group_cols[group].append(col)
         if group_to_col:
-            dict_group_cols = {g: [k for k, v in dict_col_group.items() if v == g] for g in groups}
             return dict_group_cols
         return dict_col_group
 
@@ -273,13 +374,13 @@ class cImpute:
         d_max: int
             Maximum of detected values
         """
-        df = df.copy()
         all_group_cols = self.get_all_group_cols(dict_group_cols=dict_group_cols)
-        d_min, up_mnar = get_up_mnar(df=df[all_group_cols], loc_up_mnar=loc_up_mnar)
-        d_max = df[all_group_cols].max().max()
+        X = df[all_group_cols].to_numpy(dtype=np.float64)
+        d_min, up_mnar, d_max = _get_limits(X=X, loc_up_mnar=loc_up_mnar)
         return d_min, up_mnar, d_max
 
-    def run(self, df=None, dict_group_cols=None, loc_up_mnar=0.2, min_cs=0.5, std_factor=0.8, n_neigbhors=6):
+    def run(self, df=None, dict_group_cols=None, loc_up_mnar=0.2, min_cs=0.5, std_factor=0.8, n_neigbhors=6,
+            d_min=None, up_mnar=None):
         """Hybrid method for imputation of omics data called conditional imputation (cImpute)
         using MinProb for MNAR (Missing Not at Random) missing values and KNN imputation for
         MCAR (Missing completely at Random) missing values.
@@ -299,45 +400,50 @@ class cImpute:
             relative to distance of upMNAR and Dmin.
         n_neigbhors: int, default=6 (KNN imputation parameter)
             Number of neighboring samples to use for imputation.
+        d_min: int, optional
+            Minimum of detected values from cImpute.get_limits (computed from df if d_min or up_mnar not given)
+        up_mnar: int, optional
+            Upper bound of MNAR MVs from cImpute.get_limits (computed from df if d_min or up_mnar not given)
 
         Return
         ------
         df_imputed: DataFrame
             DataFrame with (a) imputed intensities values and (b) group-wise confidence score and NaN classification.
         """
-        df = df.copy()
         all_group_cols = self.get_all_group_cols(dict_group_cols=dict_group_cols)
-        d_min, up_mnar = get_up_mnar(df=df[all_group_cols], loc_up_mnar=loc_up_mnar)
-        # TODO change to numpy Arrays & compute summary statistic (n MVs per class and group)
-        list_df_groups = []
+        # Intensities of all groups (copy of df), imputed group-wise in-place. Groups are consecutive column slices
+        X = df[all_group_cols].to_numpy(dtype=np.float64, copy=True)
+        mask_nan = np.isnan(X)
+        if d_min is None or up_mnar is None:
+            d_min, up_mnar = get_up_mnar(df=X, loc_up_mnar=loc_up_mnar)
+        knn_imputer = self._get_knn_imputer(n_neighbors=n_neigbhors)
+        # TODO compute summary statistic (n MVs per class and group)
         list_mv_classes = []
-        cs_vals = []
-        for group in dict_group_cols:
-            cols = dict_group_cols[group]
-            df_group = df[cols]
-            mv_classes = classify_of_mvs(df_group=df_group, up_mnar=up_mnar)
-            list_cs = compute_cs(df_group=df_group, mv_classes=mv_classes)
-            df_group = impute(df_group=df_group, mv_classes=mv_classes, list_cs=list_cs,
-                              min_cs=min_cs,
-                              d_min=d_min, up_mnar=up_mnar,
-                              std_factor=std_factor,
-                              n_neighbors=n_neigbhors)
-            list_df_groups.append(df_group)
+        cs_vals = np.empty((len(df), len(dict_group_cols)), dtype=np.float64)    # Proteins x groups
+        start = 0
+        for i, group in enumerate(dict_group_cols):
+            group_slice = slice(start, start + len(dict_group_cols[group]))
+            start = group_slice.stop
+            X_group = X[:, group_slice]
+            mask_nan_group = mask_nan[:, group_slice]
+            mv_classes, list_cs = classify_and_compute_cs(df_group=X_group, up_mnar=up_mnar, mask_nan=mask_nan_group)
+            _impute_group(X=X, cols=group_slice, mv_classes=mv_classes, list_cs=list_cs,
+                          min_cs=min_cs,
+                          d_min=d_min, up_mnar=up_mnar,
+                          std_factor=std_factor,
+                          n_neighbors=n_neigbhors,
+                          knn_imputer=knn_imputer,
+                          mask_nan=mask_nan_group)
             list_mv_classes.append(mv_classes)
-            cs_vals.append(list_cs)
-        # Merge imputation for all groups
-        df_imputed = pd.concat(list_df_groups, axis=1)
-        # Add aggregated CS values (mean and std)
-        cs_means = np.array(cs_vals).mean(axis=0).round(2)
-        cs_stds = np.array(cs_vals).std(axis=0).round(2)
-        df_imputed.insert(len(list(df_imputed)), "CS_MEAN", cs_means)
-        df_imputed.insert(len(list(df_imputed)), "CS_STD", cs_stds)
-        # Add  CS values per group
-        df_cs = pd.DataFrame(cs_vals).T
-        df_cs.columns = [f"CS_{group}" for group in dict_group_cols]
-        df_cs.index = df.index
-        df_nan = pd.DataFrame(list_mv_classes).T
-        df_nan.columns = [f"NaN_{group}" for group in dict_group_cols]
-        df_nan.index = df.index
-        df_imputed = pd.concat([df_imputed, df_cs, df_nan], axis=1)
+            cs_vals[:, i] = list_cs
+        # Merge imputed intensities with aggregated CS values (mean and std) and CS values per group
+        cs_means = cs_vals.mean(axis=1).round(2)
+        cs_stds = cs_vals.std(axis=1).round(2)
+        cols_cs = ["CS_MEAN", "CS_STD"] + [f"CS_{group}" for group in dict_group_cols]
+        df_imputed = pd.DataFrame(np.column_stack([X, cs_means, cs_stds, cs_vals]),
+                                  index=df.index, columns=all_group_cols + cols_cs)
+        # Add NaN classification per group (integer codes converted to class names)
+        arr_mv_classes = np.array(LIST_MV_CLASSES)
+        for group, mv_classes in zip(dict_group_cols, list_mv_classes):
+            df_imputed[f"NaN_{group}"] = arr_mv_classes[mv_classes]
         return df_imputed
@@ -37,15 +37,17 @@ def dev():
 
     # Imputation
     loc_up_mnar = 0.2
-    d_min, up_mnar, d_max = cimp.get_limits(df=df_raw.copy(),
+    d_min, up_mnar, d_max = cimp.get_limits(df=df_raw,
                                             dict_group_cols=dict_group_cols,
                                             loc_up_mnar=loc_up_mnar)
-    df_imputed = cimp.run(df=df_raw.copy(),
+    df_imputed = cimp.run(df=df_raw,
                           dict_group_cols=dict_group_cols,
                           min_cs=0.5,
                           loc_up_mnar=loc_up_mnar,
                           std_factor=1,
-                          n_neigbhors=6)
+                          n_neigbhors=6,
+                          d_min=d_min,
+                          up_mnar=up_mnar)
     df_imputed.to_excel(ut.FOLDER_RESULTS + "cImpute_data_proteomics_lfq.xlsx")
     # Plot histogram
     plot_hist(df_raw=df_raw,